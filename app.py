@@ -1,101 +1,368 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
+from flask_compress import Compress
 import os
+import sys
 import json
 import time
-from datetime import datetime, timedelta
-import psycopg
 from psycopg.rows import dict_row
-import base64
+from psycopg_pool import ConnectionPool
+import atexit
+try:
+    # SIMD-декодер base64 (в разы быстрее stdlib на фото в несколько МБ)
+    import pybase64 as base64
+except ImportError:
+    import base64
+import glob
+import hashlib
 import logging
+import logging.handlers
 import random
-from threading import Thread
-import io
+from threading import Thread, Event
+import queue
+from functools import lru_cache
+import orjson
+
+class OrjsonProvider(DefaultJSONProvider):
+    # Разбор request.json и любой jsonify идут через orjson, а не stdlib json
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype=self.mimetype)
 
 app = Flask(__name__, static_folder='.', static_url_path='')
+app.json = OrjsonProvider(app)
+# Статика и фото из send_from_directory кэшируются браузером на 5 минут
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 300
 CORS(app)
+# gzip/br для JSON (анкеты, сообщения) — текст сжимается в разы
+Compress(app)
 
 logging.getLogger('psycopg').setLevel(logging.WARNING)
 
+# ✅ ЛОГИ: запрос только кладёт запись в очередь, в stdout пишет фоновый поток
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger('datingbot')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'your_bot_token_here')
 DATABASE_URL = os.getenv('DATABASE_URL')
 PHOTO_DIR = 'photos'
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', 20))
+DB_POOL_MIN_SIZE = min(int(os.getenv('DB_POOL_MIN_SIZE', 5)), DB_POOL_MAX_SIZE)
+DAILY_LIKE_LIMIT = int(os.getenv('DAILY_LIKE_LIMIT', 20))  # для is_premium не действует
 
 if not os.path.exists(PHOTO_DIR):
     os.makedirs(PHOTO_DIR, exist_ok=True)
 
+def configure_connection(conn):
+    # Запрос готовится на сервере со 2-го выполнения на соединении (по умолчанию с 6-го).
+    # Не 0: разовые DDL из init_db и редкие запросы не занимают кэш prepared statements
+    conn.prepare_threshold = 1
+
+def reset_connection(conn):
+    # init_db временно выключает autocommit — в пул соединение возвращается в исходном режиме
+    conn.autocommit = True
+
+# ✅ ПУЛ СОЕДИНЕНИЙ: соединения переиспользуются между запросами
+POOL = None
+if DATABASE_URL:
+    POOL = ConnectionPool(
+        DATABASE_URL,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        # autocommit: одиночный запрос не тратит лишние round-trip на BEGIN/COMMIT,
+        # несколько запросов подряд оборачиваем в conn.transaction()
+        kwargs={'row_factory': dict_row, 'autocommit': True},
+        configure=configure_connection,
+        reset=reset_connection,
+        open=True
+    )
+    atexit.register(POOL.close)
+
+# ✅ REDIS (опционально): общий кэш для всех воркеров; без REDIS_URL — только локальные кэши
+REDIS_URL = os.getenv('REDIS_URL')
+REDIS = None
+if REDIS_URL:
+    import redis
+    REDIS = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5)
+
+def redis_get(key):
+    if REDIS is None:
+        return None
+    try:
+        return REDIS.get(key)
+    except redis.RedisError as e:
+        # Redis недоступен — не роняем запрос, идём в Postgres
+        logger.warning('Redis error: %s', e)
+        return None
+
+def redis_set(key, value, ttl):
+    if REDIS is None:
+        return
+    try:
+        REDIS.set(key, value, ex=ttl)
+    except redis.RedisError as e:
+        logger.warning('Redis error: %s', e)
+
+def invalidate_profiles_cache(user_id):
+    # Лента пользователя зависит от его лайков и тегов — меняем версию, а не ищем ключи
+    if REDIS is None:
+        return
+    try:
+        REDIS.incr(f'profiles_ver:{user_id}')
+    except redis.RedisError as e:
+        logger.warning('Redis error: %s', e)
+
+def redis_delete(key):
+    if REDIS is None:
+        return
+    try:
+        REDIS.delete(key)
+    except redis.RedisError as e:
+        logger.warning('Redis error: %s', e)
+
 def get_db_connection():
-    if not DATABASE_URL:
+    # Контекстный менеджер: соединение возвращается в пул при выходе
+    if POOL is None:
         raise ValueError("DATABASE_URL is not set")
-    return psycopg.connect(DATABASE_URL, row_factory=dict_row)
+    return POOL.connection()
+
+@lru_cache(maxsize=256)
+def to_pg_query(query):
+    # Текст запросов конечен — замену плейсхолдеров делаем один раз на строку
+    return query.replace('?', '%s')
 
-def execute_query(query, params=(), fetch_one=False, fetch_all=False, commit=False):
-    conn = get_db_connection()
+def execute_query(query, params=(), fetch_one=False, fetch_all=False, commit=False, prepare=None):
+    # prepare=True — готовим запрос на сервере сразу, не дожидаясь prepare_threshold
     try:
-        with conn.cursor() as cur:
-            pg_query = query.replace('?', '%s')
+        with get_db_connection() as conn, conn.cursor() as cur:
+            pg_query = to_pg_query(query)
             
             if params:
-                cur.execute(pg_query, params)
+                cur.execute(pg_query, params, prepare=prepare)
             else:
-                cur.execute(pg_query)
+                cur.execute(pg_query, prepare=prepare)
             
+            # Соединение в autocommit: запрос уже зафиксирован, commit оставлен для читаемости вызовов
             result = None
             if fetch_one:
                 result = cur.fetchone()
             elif fetch_all:
                 result = cur.fetchall()
-            
-            if commit:
-                conn.commit()
                 
             return result
     except Exception as e:
-        conn.rollback()
-        print(f"Database error: {e}")
+        logger.error('Database error: %s', e)
         raise e
-    finally:
-        conn.close()
 
-def safe_execute(query, params=()):
-    conn = get_db_connection()
+def copy_rows(cur, table, columns, rows):
+    # COPY — самый быстрый путь массовой вставки: строки идут потоком, без выполнения INSERT на каждую
+    with cur.copy(f'COPY {table} ({", ".join(columns)}) FROM STDIN') as copy:
+        for row in rows:
+            copy.write_row(row)
+
+def ojson(obj, status=200):
+    # orjson сериализует списки/datetime в C; байты сразу в ответ, без промежуточной str
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
+# ✅ ФОТО: в БД (источник истины — диск на Render не переживает рестарт) + копии в Redis и PHOTO_DIR
+# Ссылка без ?v= или с устаревшей версией — кэшируем недолго, дальше браузер ревалидирует по ETag
+PHOTO_MAX_AGE = 300
+# Ссылка с ?v=<текущий photo_version> меняется при каждой замене фото — её можно кэшировать надолго
+PHOTO_VERSIONED_MAX_AGE = 30 * 86400
+PHOTO_REDIS_TTL = 3600
+# За nginx (см. DEPLOY.md): файл отдаёт nginx по X-Accel-Redirect, воркер не занят передачей байт
+PHOTO_ACCEL_PREFIX = os.getenv('PHOTO_ACCEL_PREFIX')
+PHOTO_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a')
+
+def is_image(photo_bytes):
+    # Проверяем сигнатуру файла, а не присланный клиентом mimetype
+    if photo_bytes[:4] == b'RIFF' and photo_bytes[8:12] == b'WEBP':
+        return True
+    return photo_bytes.startswith(PHOTO_SIGNATURES)
+
+def decode_photo(photo_base64):
+    # Старые клиенты шлют data URL в JSON; новые — multipart в /api/upload-photo без base64 вообще
+    _, comma, payload = photo_base64.partition(',')
+    return base64.b64decode(payload if comma else photo_base64)
+
+def photo_url(user_id, version):
+    return f'/api/photo/{user_id}?v={version or 0}'
+
+def photo_filename(user_id, etag):
+    # В имени — md5 содержимого: файл не может разойтись со своим ETag, а замена фото даёт новый файл
+    return f'{user_id}_{etag}.jpg'
+
+def photo_path(user_id, etag):
+    return os.path.join(PHOTO_DIR, photo_filename(user_id, etag))
+
+def photo_etag(photo_bytes):
+    # Совпадает с md5(photo_data) в Postgres — им же заполнены старые анкеты
+    return hashlib.md5(photo_bytes).hexdigest()
+
+def remove_photo_files(user_id, keep=None):
+    for path in glob.glob(os.path.join(glob.escape(PHOTO_DIR), f'{user_id}_*.jpg')):
+        if path != keep:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def save_photo_file(user_id, photo_bytes):
+    # Пишем во временный файл и атомарно переименовываем — читатель не увидит половину фото
+    path = photo_path(user_id, photo_etag(photo_bytes))
+    tmp_path = f'{path}.{os.getpid()}.tmp'
     try:
-        with conn.cursor() as cur:
-            pg_query = query.replace('?', '%s')
-            if params:
-                cur.execute(pg_query, params)
-            else:
-                cur.execute(pg_query)
-            conn.commit()
-            return True
-    except Exception as e:
-        conn.rollback()
+        with open(tmp_path, 'wb') as f:
+            f.write(photo_bytes)
+        os.replace(tmp_path, path)
+        # Прежние версии фото этого пользователя больше не нужны
+        remove_photo_files(user_id, keep=path)
+        return True
+    except OSError as e:
+        logger.warning('Photo file cache error: %s', e)
         return False
-    finally:
-        conn.close()
+
+def photo_redis_key(user_id, etag):
+    # Ключ по содержимому, как и имя файла: после замены фото старая копия просто истечёт по TTL
+    return f'photo:{user_id}:{etag}'
+
+def store_photo_copies(user_id, photo_bytes):
+    # Redis — общая копия для всех воркеров/инстансов, файл — локальная для sendfile
+    redis_set(photo_redis_key(user_id, photo_etag(photo_bytes)), photo_bytes, PHOTO_REDIS_TTL)
+    return save_photo_file(user_id, photo_bytes)
+
+def remove_photo_copies(user_id, etag=None):
+    if etag:
+        redis_delete(photo_redis_key(user_id, etag))
+    remove_photo_files(user_id)
 
 # ✅ КЭШИРОВАНИЕ тегов
+TAGS_REDIS_KEY = 'tags:all'
+TAGS_CACHE_TTL = 3600
+# С Redis локальная копия живёт недолго, чтобы force_refresh одного воркера дошёл до остальных
+TAGS_LOCAL_TTL = 60 if REDIS else TAGS_CACHE_TTL
 _tags_cache = None
 _tags_cache_time = 0
+_tags_body = b'[]'  # уже сериализованный ответ /api/tags
 
 def get_tags_cached(force_refresh=False):
-    global _tags_cache, _tags_cache_time
+    global _tags_cache, _tags_cache_time, _tags_body
     current_time = time.time()
     
-    if force_refresh or _tags_cache is None or (current_time - _tags_cache_time) > 3600:
+    if force_refresh or _tags_cache is None or (current_time - _tags_cache_time) > TAGS_LOCAL_TTL:
         try:
-            tags = execute_query('SELECT id, name, emoji FROM tags ORDER BY name', fetch_all=True)
+            body = None if force_refresh else redis_get(TAGS_REDIS_KEY)
+            if body:
+                tags = orjson.loads(body)
+            else:
+                tags = execute_query('SELECT id, name, emoji FROM tags ORDER BY name', fetch_all=True)
+                body = orjson.dumps(tags or [])
+                redis_set(TAGS_REDIS_KEY, body, TAGS_CACHE_TTL)
             _tags_cache = tags
             _tags_cache_time = current_time
+            _tags_body = body
         except:
             _tags_cache = []
     
     return _tags_cache or []
 
+# Интересы пользователя одной битовой маской: бит N = тег с id N (тегов в справочнике меньше 64)
+TAG_MASK_AGG = 'bit_or(1::bigint << tag_id)'
+
+# ✅ КЭШ профилей для get_user: готовое тело ответа + ETag
+USER_CACHE_TTL = 60
+USER_CACHE_MAX_SIZE = 50000
+_user_cache = {}
+
+def invalidate_user_cache(user_id):
+    _user_cache.pop(user_id, None)
+
+# ✅ ГРУППОВОЙ КОММИТ сообщений: параллельные отправки пишутся одной пачкой
+MESSAGE_BATCH_SIZE = 32
+MESSAGE_BATCH_WAIT = 0.02
+_message_queue = queue.Queue()
+
+def insert_messages(rows):
+    # Вся пачка одним COPY и одним COMMIT
+    with get_db_connection() as conn, conn.transaction(), conn.cursor() as cur:
+        copy_rows(cur, 'messages', ('chat_id', 'from_user', 'text'), rows)
+
+def flush_messages_forever():
+    while True:
+        batch = [_message_queue.get()]
+        deadline = time.time() + MESSAGE_BATCH_WAIT
+        while len(batch) < MESSAGE_BATCH_SIZE:
+            try:
+                batch.append(_message_queue.get(timeout=max(deadline - time.time(), 0)))
+            except queue.Empty:
+                break
+        
+        try:
+            insert_messages([item['row'] for item in batch])
+        except Exception as e:
+            logger.warning('Message batch error, retrying row by row: %s', e)
+            # Пачка откатилась целиком — пишем по одному, чтобы ошибка досталась только виновнику
+            for item in batch:
+                try:
+                    insert_messages([item['row']])
+                except Exception as row_error:
+                    item['error'] = row_error
+        
+        for item in batch:
+            item['done'].set()
+
+def enqueue_message(chat_id, from_user, text):
+    item = {'row': (chat_id, from_user, text), 'done': Event(), 'error': None}
+    _message_queue.put(item)
+    # Ждём коммита, чтобы клиент сразу увидел своё сообщение в /api/messages
+    item['done'].wait()
+    if item['error']:
+        raise item['error']
+
+Thread(target=flush_messages_forever, daemon=True).start()
+
+# Увеличивай при каждом изменении init_db — воркеры сверяют его со строкой в schema_version
+SCHEMA_VERSION = 4
+
+# Колонки users, добавленные после первого релиза
+USER_COLUMN_MIGRATIONS = (
+    ('photo_data', 'BYTEA'),
+    ('is_premium', 'BOOLEAN DEFAULT FALSE'),
+    ('daily_likes_used', 'INTEGER DEFAULT 0'),
+    ('last_like_reset', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
+    ('tag_mask', 'BIGINT DEFAULT 0'),
+    ('photo_version', 'INTEGER DEFAULT 0'),
+    ('photo_etag', 'TEXT'),
+)
+
+CASCADE_FOREIGN_KEYS = (
+    ('likes', (('likes_from_user_fkey', 'from_user', 'users(id)'), ('likes_to_user_fkey', 'to_user', 'users(id)'))),
+    ('chats', (('chats_user1_id_fkey', 'user1_id', 'users(id)'), ('chats_user2_id_fkey', 'user2_id', 'users(id)'))),
+    ('messages', (('messages_from_user_fkey', 'from_user', 'users(id)'), ('messages_chat_id_fkey', 'chat_id', 'chats(id)'))),
+    ('user_tags', (('user_tags_user_id_fkey', 'user_id', 'users(id)'), ('user_tags_tag_id_fkey', 'tag_id', 'tags(id)'))),
+)
+
 def init_db():
-    conn = get_db_connection()
     try:
-        with conn.cursor() as c:
+        with get_db_connection() as conn, conn.cursor() as c:
+            # Миграции коммитятся поблочно вручную (DROP + ADD CONSTRAINT должны идти вместе)
+            conn.autocommit = False
             try:
                 c.execute('''
                     CREATE TABLE IF NOT EXISTS users (
@@ -110,6 +377,9 @@ def init_db():
                         is_premium BOOLEAN DEFAULT FALSE,
                         daily_likes_used INTEGER DEFAULT 0,
                         last_like_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        tag_mask BIGINT DEFAULT 0,
+                        photo_version INTEGER DEFAULT 0,
+                        photo_etag TEXT,
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     )
@@ -118,67 +388,49 @@ def init_db():
             except Exception as e:
                 conn.rollback()
             
-            # Миграция: добавить photo_data если ее нет
-            try:
-                c.execute('ALTER TABLE users ADD COLUMN photo_data BYTEA')
-                conn.commit()
-            except:
-                conn.rollback()
-            
-            safe_execute('ALTER TABLE users ADD COLUMN is_premium BOOLEAN DEFAULT FALSE')
-            safe_execute('ALTER TABLE users ADD COLUMN daily_likes_used INTEGER DEFAULT 0')
-            safe_execute('ALTER TABLE users ADD COLUMN last_like_reset TIMESTAMP DEFAULT CURRENT_TIMESTAMP')
-            
-            # ✅ СОЗДАНИЕ ИНДЕКСОВ
+            # Каждый ALTER берёт ACCESS EXCLUSIVE lock — сначала читаем схему, меняем только недостающее
             try:
-                c.execute('CREATE INDEX IF NOT EXISTS idx_users_city ON users(city)')
-                c.execute('CREATE INDEX IF NOT EXISTS idx_users_age ON users(age)')
-                c.execute('CREATE INDEX IF NOT EXISTS idx_likes_from_user ON likes(from_user)')
-                c.execute('CREATE INDEX IF NOT EXISTS idx_likes_to_user ON likes(to_user)')
-                c.execute('CREATE INDEX IF NOT EXISTS idx_chats_users ON chats(user1_id, user2_id)')
-                c.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)')
-                c.execute('CREATE INDEX IF NOT EXISTS idx_user_tags_user_id ON user_tags(user_id)')
+                c.execute("SELECT column_name FROM information_schema.columns WHERE table_schema = 'public' AND table_name = 'users'")
+                user_columns = {row['column_name'] for row in c.fetchall()}
+                for column, column_type in USER_COLUMN_MIGRATIONS:
+                    if column not in user_columns:
+                        c.execute(f'ALTER TABLE users ADD COLUMN {column} {column_type}')
+                c.execute("SELECT conname FROM pg_constraint WHERE contype = 'f' AND confdeltype = 'c'")
+                cascade_fkeys = {row['conname'] for row in c.fetchall()}
                 conn.commit()
-                print("✅ Indexes created")
             except Exception as e:
                 conn.rollback()
-                print(f"Index creation note: {e}")
+                cascade_fkeys = set()
+                logger.warning('Schema check note: %s', e)
             
             try:
-                c.execute('ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_from_user_fkey')
-                c.execute('ALTER TABLE likes DROP CONSTRAINT IF EXISTS likes_to_user_fkey')
-                c.execute('ALTER TABLE likes ADD CONSTRAINT likes_from_user_fkey FOREIGN KEY(from_user) REFERENCES users(id) ON DELETE CASCADE')
-                c.execute('ALTER TABLE likes ADD CONSTRAINT likes_to_user_fkey FOREIGN KEY(to_user) REFERENCES users(id) ON DELETE CASCADE')
-                conn.commit()
-            except:
-                conn.rollback()
-            
-            try:
-                c.execute('ALTER TABLE chats DROP CONSTRAINT IF EXISTS chats_user1_id_fkey')
-                c.execute('ALTER TABLE chats DROP CONSTRAINT IF EXISTS chats_user2_id_fkey')
-                c.execute('ALTER TABLE chats ADD CONSTRAINT chats_user1_id_fkey FOREIGN KEY(user1_id) REFERENCES users(id) ON DELETE CASCADE')
-                c.execute('ALTER TABLE chats ADD CONSTRAINT chats_user2_id_fkey FOREIGN KEY(user2_id) REFERENCES users(id) ON DELETE CASCADE')
-                conn.commit()
-            except:
-                conn.rollback()
-            
-            try:
-                c.execute('ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_from_user_fkey')
-                c.execute('ALTER TABLE messages DROP CONSTRAINT IF EXISTS messages_chat_id_fkey')
-                c.execute('ALTER TABLE messages ADD CONSTRAINT messages_from_user_fkey FOREIGN KEY(from_user) REFERENCES users(id) ON DELETE CASCADE')
-                c.execute('ALTER TABLE messages ADD CONSTRAINT messages_chat_id_fkey FOREIGN KEY(chat_id) REFERENCES chats(id) ON DELETE CASCADE')
+                c.execute('''
+                    CREATE TABLE IF NOT EXISTS likes (
+                        id SERIAL PRIMARY KEY,
+                        from_user BIGINT,
+                        to_user BIGINT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        UNIQUE(from_user, to_user),
+                        FOREIGN KEY(from_user) REFERENCES users(id) ON DELETE CASCADE,
+                        FOREIGN KEY(to_user) REFERENCES users(id) ON DELETE CASCADE
+                    )
+                ''')
                 conn.commit()
             except:
                 conn.rollback()
             
-            try:
-                c.execute('ALTER TABLE user_tags DROP CONSTRAINT IF EXISTS user_tags_user_id_fkey')
-                c.execute('ALTER TABLE user_tags DROP CONSTRAINT IF EXISTS user_tags_tag_id_fkey')
-                c.execute('ALTER TABLE user_tags ADD CONSTRAINT user_tags_user_id_fkey FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE')
-                c.execute('ALTER TABLE user_tags ADD CONSTRAINT user_tags_tag_id_fkey FOREIGN KEY(tag_id) REFERENCES tags(id) ON DELETE CASCADE')
-                conn.commit()
-            except:
-                conn.rollback()
+            # Внешние ключи с ON DELETE CASCADE пересоздаём только если их ещё нет
+            for table, constraints in CASCADE_FOREIGN_KEYS:
+                if all(name in cascade_fkeys for name, _, _ in constraints):
+                    continue
+                try:
+                    for name, _, _ in constraints:
+                        c.execute(f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {name}')
+                    for name, column, reference in constraints:
+                        c.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} FOREIGN KEY({column}) REFERENCES {reference} ON DELETE CASCADE')
+                    conn.commit()
+                except:
+                    conn.rollback()
             
             try:
                 c.execute('''
@@ -242,11 +494,7 @@ def init_db():
                         ('Food', '🍕'),
                         ('Fashion', '👗')
                     ]
-                    for name, emoji in tags_data:
-                        try:
-                            c.execute('INSERT INTO tags (name, emoji) VALUES (%s, %s)', (name, emoji))
-                        except:
-                            pass
+                    copy_rows(c, 'tags', ('name', 'emoji'), tags_data)
                     conn.commit()
             except:
                 conn.rollback()
@@ -265,47 +513,150 @@ def init_db():
             except:
                 conn.rollback()
             
-            print("✅ Database is ready!")
-    except Exception as e:
-        print(f"Init DB error: {e}")
-    finally:
-        conn.close()
+            # Заполняем tag_mask для анкет, сохранённых до появления колонки
+            try:
+                c.execute(f'''
+                    UPDATE users u SET tag_mask = m.mask
+                    FROM (SELECT user_id, {TAG_MASK_AGG} AS mask FROM user_tags WHERE tag_id < 64 GROUP BY user_id) m
+                    WHERE m.user_id = u.id AND u.tag_mask IS DISTINCT FROM m.mask
+                ''')
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.warning('Tag mask backfill note: %s', e)
+            
+            # ETag для фото, загруженных до появления колонки
+            try:
+                c.execute('UPDATE users SET photo_etag = md5(photo_data) WHERE photo_data IS NOT NULL AND photo_etag IS NULL')
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                logger.warning('Photo etag backfill note: %s', e)
+            
+            # ✅ СОЗДАНИЕ ИНДЕКСОВ
+            try:
+                c.execute('CREATE INDEX IF NOT EXISTS idx_users_age ON users(age)')
+                # Префиксы составных индексов: from_user — UNIQUE(from_user, to_user), to_user — idx_likes_to_from
+                c.execute('DROP INDEX IF EXISTS idx_likes_from_user')
+                c.execute('DROP INDEX IF EXISTS idx_likes_to_user')
+                # chats(user1_id, ...) — UNIQUE(user1_id, user2_id), messages(chat_id) — idx_messages_chat_created,
+                # user_tags(user_id) — PRIMARY KEY (user_id, tag_id)
+                c.execute('DROP INDEX IF EXISTS idx_chats_users')
+                c.execute('DROP INDEX IF EXISTS idx_chats_user1')
+                c.execute('DROP INDEX IF EXISTS idx_messages_chat_id')
+                c.execute('DROP INDEX IF EXISTS idx_user_tags_user_id')
+                # Обратный поиск взаимного лайка и выборки чатов/сообщений без seq scan
+                c.execute('CREATE INDEX IF NOT EXISTS idx_likes_to_from ON likes(to_user, from_user)')
+                c.execute('CREATE INDEX IF NOT EXISTS idx_chats_user2 ON chats(user2_id) INCLUDE (user1_id)')
+                c.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages(chat_id, created_at DESC)')
+                # Поиск по тегу (кто ещё отметил этот интерес) — index-only scan
+                c.execute('CREATE INDEX IF NOT EXISTS idx_user_tags_tag ON user_tags(tag_id) INCLUDE (user_id)')
+                conn.commit()
+                logger.info('✅ Indexes created')
+            except Exception as e:
+                conn.rollback()
+                logger.warning('Index creation note: %s', e)
+            
+            # Фильтр города — ILIKE '%...%': b-tree по city для него бесполезен, триграммный GIN — нет
+            try:
+                c.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+                c.execute('CREATE INDEX IF NOT EXISTS idx_users_city_trgm ON users USING GIN (city gin_trgm_ops)')
+                c.execute('DROP INDEX IF EXISTS idx_users_city')
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                c.execute('CREATE INDEX IF NOT EXISTS idx_users_city ON users(city)')
+                conn.commit()
+                logger.warning('Trigram index note: %s', e)
+            
+            c.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+                    version INTEGER NOT NULL
+                )
+            ''')
+            c.execute('''INSERT INTO schema_version (version) VALUES (%s)
+                ON CONFLICT (id) DO UPDATE SET version = EXCLUDED.version''', (SCHEMA_VERSION,))
+            conn.commit()
+            logger.info('✅ Database is ready!')
+            return True
+    except Exception:
+        logger.exception('Init DB error')
+    return False
 
-try:
-    if DATABASE_URL:
-        init_db()
-        get_tags_cached()
-except:
-    pass
+def get_schema_version():
+    # Один дешёвый запрос вместо ~20 DDL-round-trip при старте каждого воркера.
+    # None — таблиц ещё нет, 0 — схема создана до появления schema_version
+    row = execute_query('''
+        SELECT to_regclass('public.users') IS NOT NULL AS ready,
+               to_regclass('public.schema_version') IS NOT NULL AS versioned
+    ''', fetch_one=True)
+    if not row['ready']:
+        return None
+    if not row['versioned']:
+        return 0
+    row = execute_query('SELECT version FROM schema_version', fetch_one=True)
+    return row['version'] if row else 0
 
-def reset_daily_likes(user_id):
+if DATABASE_URL:
+    # Миграции гоняет `python migrate.py` (build.sh), а не воркеры: ALTER/ADD CONSTRAINT
+    # на живой базе берут ACCESS EXCLUSIVE и блокируют запросы на время rolling deploy.
+    # Но на отставшей схеме код работать не может (нет tag_mask, photo_version, photo_etag),
+    # поэтому пустую или устаревшую базу воркер догоняет сам, а не сможет — не стартует
     try:
-        user = execute_query('SELECT last_like_reset FROM users WHERE id = ?', (user_id,), fetch_one=True)
-        if user and user['last_like_reset']:
-            time_since_reset = (datetime.now(user['last_like_reset'].tzinfo or None) - user['last_like_reset']).total_seconds()
-            if time_since_reset > 86400:
-                execute_query('UPDATE users SET daily_likes_used = 0, last_like_reset = CURRENT_TIMESTAMP WHERE id = ?', (user_id,), commit=True)
-    except:
-        pass
+        schema_version = get_schema_version()
+    except Exception:
+        # БД недоступна — как и раньше, стартуем: пул переподключится к ней сам
+        logger.exception('Schema version check error')
+        schema_version = SCHEMA_VERSION
+    needs_migration = schema_version is None or schema_version < SCHEMA_VERSION
+    if schema_version is not None and needs_migration:
+        logger.warning('Schema version %s < %s — migrating on startup, run `python migrate.py` in the build', schema_version, SCHEMA_VERSION)
+    if needs_migration or os.getenv('RUN_MIGRATIONS') == '1':
+        if not init_db() and needs_migration:
+            raise RuntimeError(f'Database schema is older than {SCHEMA_VERSION} and migration failed')
+    try:
+        get_tags_cached()
+    except Exception:
+        logger.exception('Tags cache warm-up error')
 
 @app.route('/api/tags', methods=['GET'])
 def get_tags():
-    tags = get_tags_cached()
-    return jsonify(tags or [])
+    # Теги почти не меняются — отдаём готовые байты без сериализации на каждый запрос
+    get_tags_cached()
+    return app.response_class(_tags_body, mimetype='application/json')
 
 @app.route('/api/user/<int:user_id>', methods=['GET'])
 def get_user(user_id):
-    user = execute_query('SELECT id, name, age, city, bio FROM users WHERE id = ?', (user_id,), fetch_one=True)
-    if user:
-        tags = execute_query('''
-            SELECT t.id, t.name, t.emoji FROM user_tags ut
-            JOIN tags t ON ut.tag_id = t.id
-            WHERE ut.user_id = ?
-        ''', (user_id,), fetch_all=True)
-        user['tags'] = tags or []
-        user['photo_url'] = f'/api/photo/{user_id}' if user else None
-        return jsonify(user)
-    return jsonify({'error': 'User not found'}), 404
+    cached = _user_cache.get(user_id)
+    if not cached or time.time() - cached[0] > USER_CACHE_TTL:
+        # Анкета и теги одним запросом: список тегов собирает json_agg на стороне Postgres
+        user = execute_query('''
+            SELECT u.id, u.name, u.age, u.city, u.bio,
+                COALESCE(json_agg(json_build_object('id', t.id, 'name', t.name, 'emoji', t.emoji) ORDER BY t.id)
+                    FILTER (WHERE t.id IS NOT NULL), '[]') AS tags,
+                u.photo_version
+            FROM users u
+            LEFT JOIN user_tags ut ON ut.user_id = u.id
+            LEFT JOIN tags t ON t.id = ut.tag_id
+            WHERE u.id = ?
+            GROUP BY u.id
+        ''', (user_id,), fetch_one=True, prepare=True)
+        if not user:
+            return ojson({'error': 'User not found'}, 404)
+        user['photo_url'] = photo_url(user_id, user.pop('photo_version'))
+        
+        body = orjson.dumps(user)
+        if len(_user_cache) >= USER_CACHE_MAX_SIZE:
+            _user_cache.clear()
+        cached = (time.time(), body, hashlib.blake2b(body, digest_size=8).hexdigest())
+        _user_cache[user_id] = cached
+    
+    _, body, etag = cached
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    # 304 без тела, если у клиента та же версия (If-None-Match)
+    return response.make_conditional(request)
 
 @app.route('/api/user', methods=['POST'])
 def create_user():
@@ -313,43 +664,91 @@ def create_user():
     try:
         photo_data = None
         if data.get('photo_data'):
-            photo_base64 = data['photo_data']
-            if ',' in photo_base64:
-                photo_base64 = photo_base64.split(',')[1]
-            photo_data = base64.b64decode(photo_base64)
+            photo_data = decode_photo(data['photo_data'])
+            if not is_image(photo_data):
+                return ojson({'error': 'Unsupported image format'}, 400)
         
-        execute_query('''
-            INSERT INTO users (id, name, age, city, bio, photo_data, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-            ON CONFLICT (id) DO UPDATE SET
-            name = EXCLUDED.name,
-            age = EXCLUDED.age,
-            city = EXCLUDED.city,
-            bio = EXCLUDED.bio,
-            photo_data = EXCLUDED.photo_data,
-            updated_at = CURRENT_TIMESTAMP
-        ''', (
-            data['id'], data['name'], data.get('age'), data.get('city'),
-            data.get('bio'), photo_data
-        ), commit=True)
+        # Анкета и теги — одна транзакция, отправленная pipeline'ом: один round-trip вместо пяти
+        with get_db_connection() as conn, conn.pipeline(), conn.transaction():
+            upsert = conn.execute('''
+                INSERT INTO users (id, name, age, city, bio, photo_data, photo_etag, photo_version, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, CASE WHEN %s THEN 1 ELSE 0 END, CURRENT_TIMESTAMP)
+                ON CONFLICT (id) DO UPDATE SET
+                name = EXCLUDED.name,
+                age = EXCLUDED.age,
+                city = EXCLUDED.city,
+                bio = EXCLUDED.bio,
+                -- Без нового фото в запросе оставляем загруженное через /api/upload-photo
+                photo_data = COALESCE(EXCLUDED.photo_data, users.photo_data),
+                photo_etag = COALESCE(EXCLUDED.photo_etag, users.photo_etag),
+                photo_version = COALESCE(users.photo_version, 0) + EXCLUDED.photo_version,
+                updated_at = CURRENT_TIMESTAMP
+                RETURNING photo_version
+            ''', (
+                data['id'], data['name'], data.get('age'), data.get('city'),
+                data.get('bio'), photo_data, photo_data and photo_etag(photo_data), photo_data is not None
+            ))
+            if data.get('tag_ids'):
+                # Сверяем с массивом: удаляем только снятые теги, вставляем только новые —
+                # неизменившиеся строки не переписываются и не плодят мёртвые версии
+                conn.execute('DELETE FROM user_tags WHERE user_id = %s AND tag_id <> ALL(%s::int[])', (data['id'], data['tag_ids']))
+                conn.execute('''INSERT INTO user_tags (user_id, tag_id)
+                    SELECT %s, unnest(%s::int[]) ON CONFLICT DO NOTHING''', (data['id'], data['tag_ids']))
+                conn.execute(f'''UPDATE users SET tag_mask = (
+                    SELECT COALESCE({TAG_MASK_AGG}, 0) FROM user_tags WHERE user_id = %s AND tag_id < 64
+                ) WHERE id = %s''', (data['id'], data['id']))
+            saved = upsert.fetchone()
+        if photo_data:
+            store_photo_copies(data['id'], photo_data)
+        invalidate_user_cache(data['id'])
+        invalidate_profiles_cache(data['id'])
         
-        if data.get('tag_ids'):
-            execute_query('DELETE FROM user_tags WHERE user_id = ?', (data['id'],), commit=True)
-            for tag_id in data['tag_ids']:
-                execute_query('INSERT INTO user_tags (user_id, tag_id) VALUES (?, ?)', (data['id'], tag_id), commit=True)
-        
-        return jsonify({'success': True, 'photo_url': f"/api/photo/{data['id']}"})
+        return ojson({'success': True, 'photo_url': photo_url(data['id'], saved['photo_version'])})
     except Exception as e:
-        return jsonify({'error': str(e)}), 400
+        return ojson({'error': str(e)}, 400)
 
 @app.route('/api/user/<int:user_id>', methods=['DELETE'])
 def delete_user(user_id):
     try:
-        execute_query('DELETE FROM users WHERE id = ?', (user_id,), commit=True)
-        return jsonify({'success': True})
+        deleted = execute_query('DELETE FROM users WHERE id = ? RETURNING photo_etag', (user_id,), fetch_one=True, commit=True)
+        invalidate_user_cache(user_id)
+        remove_photo_copies(user_id, deleted and deleted['photo_etag'])
+        return ojson({'success': True})
     except Exception as e:
-        print(f"Delete user error: {e}")
-        return jsonify({'error': str(e)}), 400
+        logger.exception('Delete user error')
+        return ojson({'error': str(e)}, 400)
+
+PROFILES_PAGE_SIZE = 50
+PROFILES_CACHE_TTL = 45
+PROFILE_COLUMNS = ('id', 'name', 'age', 'city', 'bio', 'tags', 'photo_url')
+
+@lru_cache(maxsize=2)
+def feed_query(with_city):
+    # Всего две формы запроса (с фильтром города и без) — собираем и переводим в %s один раз
+    # Анти-джойн на стороне БД: список лайкнутых не гоняем через Python
+    where_clause = '''WHERE users.id > ? AND users.id <> ?
+            AND NOT EXISTS (SELECT 1 FROM likes l WHERE l.from_user = ? AND l.to_user = users.id)
+            AND users.age >= ? AND users.age <= ?'''
+    if with_city:
+        where_clause += ' AND users.city ILIKE ?'
+    
+    # Один запрос: страница анкет + теги одним json_agg + число общих с пользователем тегов.
+    # Страница режется по id (keyset), внутри страницы — сначала анкеты с общими интересами
+    # (popcount от AND масок тегов), равные перемешиваем: random() сортирует максимум 50 строк
+    return to_pg_query(f'''WITH page AS (
+                SELECT id, name, age, city, bio, tag_mask, photo_version FROM users {where_clause}
+                ORDER BY users.id LIMIT {PROFILES_PAGE_SIZE}
+            )
+            SELECT p.id, p.name, p.age, p.city, p.bio,
+                COALESCE(json_agg(json_build_object('id', t.id, 'name', t.name, 'emoji', t.emoji) ORDER BY t.id)
+                    FILTER (WHERE t.id IS NOT NULL), '[]') AS tags,
+                bit_count((COALESCE(p.tag_mask, 0) & (SELECT COALESCE(tag_mask, 0) FROM users WHERE id = ?))::bit(64)) AS common_tags_count,
+                p.photo_version
+            FROM page p
+            LEFT JOIN user_tags ut ON ut.user_id = p.id
+            LEFT JOIN tags t ON t.id = ut.tag_id
+            GROUP BY p.id, p.name, p.age, p.city, p.bio, p.tag_mask, p.photo_version
+            ORDER BY common_tags_count DESC, random()''')
 
 @app.route('/api/profiles/<int:user_id>', methods=['GET'])
 def get_profiles(user_id):
@@ -357,46 +756,40 @@ def get_profiles(user_id):
         age_min = int(request.args.get('age_min', 18))
         age_max = int(request.args.get('age_max', 99))
         city = request.args.get('city', '')
+        # Keyset-пагинация: клиент присылает id последней показанной анкеты
+        after_id = int(request.args.get('after_id', 0))
+        layout = request.args.get('layout', 'rows')
         
-        reset_daily_likes(user_id)
-        
-        interacted = execute_query('SELECT to_user FROM likes WHERE from_user = ?', (user_id,), fetch_all=True)
-        interacted_ids = [row['to_user'] for row in (interacted or [])] + [user_id]
-        
-        where_clause = f'WHERE users.id NOT IN ({" , ".join(["%s"] * len(interacted_ids))})'  
-        where_clause += f' AND users.age >= %s AND users.age <= %s'
+        # Версия в ключе растёт при лайке/сохранении анкеты — старые ключи просто истекают, без SCAN
+        cache_key = None
+        if REDIS is not None:
+            version = (redis_get(f'profiles_ver:{user_id}') or b'0').decode()
+            cache_key = f'profiles:{user_id}:{version}:{age_min}:{age_max}:{city}:{after_id}:{layout}'
+            cached = redis_get(cache_key)
+            if cached:
+                return app.response_class(cached, mimetype='application/json')
         
+        params = (after_id, user_id, user_id, age_min, age_max)
         if city:
-            where_clause += ' AND users.city ILIKE %s'
-            params = tuple(interacted_ids) + (age_min, age_max, f'%{city}%')
-        else:
-            params = tuple(interacted_ids) + (age_min, age_max)
+            params += (f'%{city}%',)
         
-        query = f'SELECT id, name, age, city, bio FROM users {where_clause} ORDER BY RANDOM() LIMIT 50'
-        profiles = execute_query(query, params, fetch_all=True)
+        # Текст запроса не зависит от числа лайков — план кэшируется на соединении
+        profiles = execute_query(feed_query(bool(city)), params + (user_id,), fetch_all=True, prepare=True) or []
+        # URL собираем в Python: '?' в SQL-литерале превратился бы в плейсхолдер
+        for profile in profiles:
+            profile['photo_url'] = photo_url(profile['id'], profile.pop('photo_version'))
         
-        if profiles:
-            profile_ids = [p['id'] for p in profiles]
-            tags_query = f'''SELECT user_id, id, name, emoji FROM user_tags ut
-                JOIN tags t ON ut.tag_id = t.id
-                WHERE ut.user_id IN ({" , ".join(["%s"] * len(profile_ids))})'''
-            all_tags = execute_query(tags_query, tuple(profile_ids), fetch_all=True)
-            
-            tags_by_user = {}
-            for tag in (all_tags or []):
-                uid = tag['user_id']
-                if uid not in tags_by_user:
-                    tags_by_user[uid] = []
-                tags_by_user[uid].append({'id': tag['id'], 'name': tag['name'], 'emoji': tag['emoji']})
-            
-            for profile in profiles:
-                profile['tags'] = tags_by_user.get(profile['id'], [])
-                profile['photo_url'] = f"/api/photo/{profile['id']}"
-        
-        return jsonify(profiles or [])
-    except Exception as e:
-        print(f"Error: {e}")
-        return jsonify([])
+        if layout == 'columns':
+            # Колоночный формат: {"id": [...], "name": [...]} — ключи не повторяются на каждую анкету
+            body = orjson.dumps({key: [p[key] for p in profiles] for key in PROFILE_COLUMNS})
+        else:
+            body = orjson.dumps(profiles)
+        if cache_key:
+            redis_set(cache_key, body, PROFILES_CACHE_TTL)
+        return app.response_class(body, mimetype='application/json')
+    except Exception:
+        logger.exception('Get profiles error')
+        return ojson([])
 
 @app.route('/api/like', methods=['POST'])
 def like_profile():
@@ -408,41 +801,71 @@ def like_profile():
     try:
         if is_dislike:
             execute_query('DELETE FROM likes WHERE from_user = ? AND to_user = ?', (from_user, to_user), commit=True)
-            return jsonify({'match': False})
-        
-        existing = execute_query('SELECT * FROM likes WHERE from_user = ? AND to_user = ?', (from_user, to_user), fetch_one=True)
-        if not existing:
-            execute_query('INSERT INTO likes (from_user, to_user) VALUES (?, ?)', (from_user, to_user), commit=True)
+            invalidate_profiles_cache(from_user)
+            return ojson({'match': False})
         
-        mutual = execute_query('SELECT * FROM likes WHERE from_user = ? AND to_user = ?', (to_user, from_user), fetch_one=True)
+        # Лимит, лайк, счётчик, проверка взаимности и создание чата — один атомарный запрос.
+        # FOR UPDATE на строке пользователя: параллельные лайки не обойдут лимит
+        result = execute_query('''
+            WITH lim AS (
+                SELECT COALESCE(is_premium, FALSE) AS is_premium,
+                    last_like_reset IS NULL OR last_like_reset < CURRENT_TIMESTAMP - INTERVAL '1 day' AS stale,
+                    COALESCE(daily_likes_used, 0) AS used
+                FROM users WHERE id = ? FOR UPDATE
+            ), allowed AS (
+                SELECT stale FROM lim WHERE is_premium OR stale OR used < ?
+            ), ins AS (
+                INSERT INTO likes (from_user, to_user)
+                SELECT ?, ? FROM allowed
+                ON CONFLICT DO NOTHING
+                RETURNING 1
+            ), bump AS (
+                UPDATE users SET
+                    daily_likes_used = CASE WHEN allowed.stale THEN 1 ELSE COALESCE(users.daily_likes_used, 0) + 1 END,
+                    last_like_reset = CASE WHEN allowed.stale THEN CURRENT_TIMESTAMP ELSE users.last_like_reset END
+                FROM allowed
+                WHERE users.id = ? AND EXISTS (SELECT 1 FROM ins)
+            ), mutual AS (
+                SELECT 1 FROM likes WHERE from_user = ? AND to_user = ? AND EXISTS (SELECT 1 FROM allowed)
+            ), new_chat AS (
+                INSERT INTO chats (user1_id, user2_id)
+                SELECT LEAST(?, ?), GREATEST(?, ?)
+                WHERE EXISTS (SELECT 1 FROM mutual)
+                ON CONFLICT DO NOTHING
+            )
+            SELECT EXISTS (SELECT 1 FROM lim) AS user_exists,
+                EXISTS (SELECT 1 FROM mutual) AS matched,
+                NOT EXISTS (SELECT 1 FROM allowed) AS limit_reached
+        ''', (from_user, DAILY_LIKE_LIMIT, from_user, to_user, from_user,
+              to_user, from_user, from_user, to_user, from_user, to_user), fetch_one=True, commit=True, prepare=True)
         
-        if mutual:
-            u1, u2 = sorted([from_user, to_user])
-            execute_query('INSERT INTO chats (user1_id, user2_id) VALUES (?, ?) ON CONFLICT DO NOTHING', (u1, u2), commit=True)
-            return jsonify({'match': True})
+        # Нет строки from_user — lim пуст, и без этой проверки ответ выглядел бы как исчерпанный лимит
+        if not result['user_exists']:
+            return ojson({'error': 'User not found', 'match': False}, 404)
         
-        return jsonify({'match': False})
+        invalidate_profiles_cache(from_user)
+        return ojson({'match': result['matched'], 'limit_reached': result['limit_reached']})
     except Exception as e:
-        print(f"Like error: {e}")
-        return jsonify({'error': str(e), 'match': False}), 400
+        logger.exception('Like error')
+        return ojson({'error': str(e), 'match': False}, 400)
 
 @app.route('/api/likes/<int:user_id>', methods=['GET'])
 def get_likes(user_id):
     try:
         likes = execute_query('''
-            SELECT u.id, u.name, u.age, u.city
+            SELECT u.id, u.name, u.age, u.city, u.photo_version
             FROM likes l
             JOIN users u ON l.from_user = u.id
             WHERE l.to_user = ?
         ''', (user_id,), fetch_all=True)
         
         for like in (likes or []):
-            like['photo_url'] = f"/api/photo/{like['id']}"
+            like['photo_url'] = photo_url(like['id'], like.pop('photo_version'))
         
-        return jsonify(likes or [])
-    except Exception as e:
-        print(f"Get likes error: {e}")
-        return jsonify([])
+        return ojson(likes or [])
+    except Exception:
+        logger.exception('Get likes error')
+        return ojson([])
 
 @app.route('/api/chats/<int:user_id>', methods=['GET'])
 def get_chats(user_id):
@@ -451,44 +874,59 @@ def get_chats(user_id):
             SELECT 
                 CASE WHEN user1_id = %s THEN user2_id ELSE user1_id END as user_id,
                 u.name as user_name,
+                u.photo_version,
                 c.id as chat_id,
                 c.created_at,
-                (SELECT text FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message
+                COALESCE(last.text, 'Начни разговор...') as last_message
             FROM chats c
             JOIN users u ON (CASE WHEN c.user1_id = %s THEN c.user2_id ELSE c.user1_id END) = u.id
+            -- Последнее сообщение — один index seek по (chat_id, created_at DESC) на чат
+            LEFT JOIN LATERAL (
+                SELECT text FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1
+            ) last ON TRUE
             WHERE c.user1_id = %s OR c.user2_id = %s
             ORDER BY c.created_at DESC
         ''', (user_id, user_id, user_id, user_id), fetch_all=True)
         
         for chat in (chats or []):
-            if not chat['last_message']:
-                chat['last_message'] = 'Начни разговор...'
-            chat['user_photo'] = f"/api/photo/{chat['user_id']}"
+            chat['user_photo'] = photo_url(chat['user_id'], chat.pop('photo_version'))
         
-        return jsonify(chats or [])
-    except Exception as e:
-        print(f"Get chats error: {e}")
-        return jsonify([])
+        return ojson(chats or [])
+    except Exception:
+        logger.exception('Get chats error')
+        return ojson([])
+
+MESSAGES_PAGE_SIZE = 50
 
 @app.route('/api/messages/<int:user_id_1>/<int:user_id_2>', methods=['GET'])
 def get_messages(user_id_1, user_id_2):
     try:
-        u1, u2 = sorted([user_id_1, user_id_2])
-        chat = execute_query('SELECT id FROM chats WHERE user1_id = ? AND user2_id = ?', (u1, u2), fetch_one=True)
+        params = (user_id_1, user_id_2, user_id_1, user_id_2)
+        # Листание истории вверх: ?before=<id самого старого показанного сообщения>.
+        # Сравниваем пару (created_at, id) — сообщения одной пачки group commit имеют одинаковое время
+        before_clause = ''
+        before = request.args.get('before', type=int)
+        if before:
+            before_clause = 'AND (m.created_at, m.id) < (SELECT created_at, id FROM messages WHERE id = ?)'
+            params += (before,)
         
-        if not chat:
-            return jsonify([])
-        
-        messages = execute_query('''
-            SELECT from_user, text, created_at
-            FROM messages
-            WHERE chat_id = ?
-            ORDER BY created_at ASC
-        ''', (chat['id'],), fetch_all=True)
-        return jsonify(messages or [])
-    except Exception as e:
-        print(f"Get messages error: {e}")
-        return jsonify([])
+        # Ключ чата (LEAST/GREATEST) считаем в SQL — сразу JOIN без отдельного поиска чата.
+        # Последние MESSAGES_PAGE_SIZE по индексу (chat_id, created_at DESC), порядок — тоже в SQL
+        messages = execute_query(f'''
+            SELECT id, from_user, text, created_at FROM (
+                SELECT m.id, m.from_user, m.text, m.created_at
+                FROM chats c
+                JOIN messages m ON m.chat_id = c.id
+                WHERE c.user1_id = LEAST(?, ?) AND c.user2_id = GREATEST(?, ?) {before_clause}
+                ORDER BY m.created_at DESC, m.id DESC
+                LIMIT {MESSAGES_PAGE_SIZE}
+            ) last_messages
+            ORDER BY created_at ASC, id ASC
+        ''', params, fetch_all=True)
+        return ojson(messages or [])
+    except Exception:
+        logger.exception('Get messages error')
+        return ojson([])
 
 @app.route('/api/message', methods=['POST'])
 def send_message():
@@ -498,71 +936,149 @@ def send_message():
     text = data.get('text')
     
     try:
-        u1, u2 = sorted([from_user, to_user])
-        chat = execute_query('SELECT id FROM chats WHERE user1_id = ? AND user2_id = ?', (u1, u2), fetch_one=True)
+        chat_key = (from_user, to_user, from_user, to_user)
+        # Найти или создать чат — один запрос вместо SELECT / INSERT / SELECT
+        chat = execute_query('''
+            WITH found AS (
+                SELECT id FROM chats WHERE user1_id = LEAST(?, ?) AND user2_id = GREATEST(?, ?)
+            ), created AS (
+                INSERT INTO chats (user1_id, user2_id)
+                SELECT LEAST(?, ?), GREATEST(?, ?)
+                WHERE NOT EXISTS (SELECT 1 FROM found)
+                ON CONFLICT DO NOTHING
+                RETURNING id
+            )
+            SELECT id FROM found UNION ALL SELECT id FROM created
+        ''', chat_key + chat_key, fetch_one=True, commit=True, prepare=True)
         
         if not chat:
-            execute_query('INSERT INTO chats (user1_id, user2_id) VALUES (?, ?)', (u1, u2), commit=True)
-            chat = execute_query('SELECT id FROM chats WHERE user1_id = ? AND user2_id = ?', (u1, u2), fetch_one=True)
+            # Чат только что создал параллельный запрос — он уже виден
+            chat = execute_query('SELECT id FROM chats WHERE user1_id = LEAST(?, ?) AND user2_id = GREATEST(?, ?)', chat_key, fetch_one=True)
         
-        execute_query('''
-            INSERT INTO messages (from_user, chat_id, text) VALUES (?, ?, ?)
-        ''', (from_user, chat['id'], text), commit=True)
-        return jsonify({'success': True})
+        enqueue_message(chat['id'], from_user, text)
+        return ojson({'success': True})
     except Exception as e:
-        print(f"Send message error: {e}")
-        return jsonify({'error': str(e)}), 400
+        logger.exception('Send message error')
+        return ojson({'error': str(e)}, 400)
 
 @app.route('/api/upload-photo', methods=['POST'])
 def upload_photo():
-    data = request.json
     try:
-        user_id = data['user_id']
-        photo_base64 = data['photo_data']
+        photo = request.files.get('photo')
+        if photo:
+            # multipart: бинарный файл без base64-раздувания и без разбора JSON
+            user_id = int(request.form['user_id'])
+            photo_bytes = photo.stream.read()
+        else:
+            # Совместимость со старыми клиентами: base64 data URL в JSON
+            data = request.json
+            user_id = data['user_id']
+            photo_bytes = decode_photo(data['photo_data'])
         
-        if ',' in photo_base64:
-            photo_base64 = photo_base64.split(',')[1]
+        if not is_image(photo_bytes):
+            return ojson({'error': 'Unsupported image format'}, 400)
         
-        photo_bytes = base64.b64decode(photo_base64)
-        execute_query('UPDATE users SET photo_data = ? WHERE id = ?', (photo_bytes, user_id), commit=True)
+        updated = execute_query('''
+            UPDATE users SET photo_data = ?, photo_etag = ?, photo_version = COALESCE(photo_version, 0) + 1
+            WHERE id = ? RETURNING photo_version
+        ''', (photo_bytes, photo_etag(photo_bytes), user_id), fetch_one=True, commit=True)
+        if not updated:
+            return ojson({'error': 'User not found'}, 404)
+        store_photo_copies(user_id, photo_bytes)
+        invalidate_user_cache(user_id)
         
-        return jsonify({'success': True, 'photo_url': f'/api/photo/{user_id}'})
+        return ojson({'success': True, 'photo_url': photo_url(user_id, updated['photo_version'])})
     except Exception as e:
-        print(f"Photo upload error: {e}")
-        return jsonify({'error': str(e)}), 400
+        logger.exception('Photo upload error')
+        return ojson({'error': str(e)}, 400)
 
 @app.route('/api/photo/<int:user_id>', methods=['GET'])
 def get_photo(user_id):
     try:
-        user = execute_query('SELECT photo_data FROM users WHERE id = ?', (user_id,), fetch_one=True)
-        if user and user['photo_data']:
-            return send_file(
-                io.BytesIO(user['photo_data']),
-                mimetype='image/jpeg',
-                as_attachment=False
-            )
+        # Строку проверяем до локальной копии: анкету могли удалить через другой инстанс,
+        # и его remove_photo_copies до нашего диска не дотянулся. Запрос по ключу, без BYTEA
+        user = execute_query('SELECT photo_etag, photo_version FROM users WHERE id = ?', (user_id,), fetch_one=True, prepare=True)
+        if not user:
+            remove_photo_copies(user_id)
+            return '', 404
+        if not user['photo_etag']:
+            # Фото нет — нет и копий на диске, glob по PHOTO_DIR не нужен
+            return '', 404
+        # Надолго кэшируем только ссылку на текущую версию: старая ?v= после замены фото должна скоро перепроверяться
+        if request.args.get('v') == str(user['photo_version'] or 0):
+            max_age = PHOTO_VERSIONED_MAX_AGE
+        else:
+            max_age = PHOTO_MAX_AGE
+        etag = user['photo_etag']
+        if etag in request.if_none_match:
+            # Браузер уже держит это фото — 304 без чтения файла
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            return response
+        if not os.path.exists(photo_path(user_id, etag)):
+            # После рестарта диск пуст — берём копию из Redis, если нет и там — из БД
+            photo_bytes = redis_get(photo_redis_key(user_id, etag))
+            if photo_bytes:
+                saved = save_photo_file(user_id, photo_bytes)
+            else:
+                user = execute_query('SELECT photo_data FROM users WHERE id = ?', (user_id,), fetch_one=True, prepare=True)
+                if not user or not user['photo_data']:
+                    return '', 404
+                photo_bytes = user['photo_data']
+                saved = store_photo_copies(user_id, photo_bytes)
+            # Фото могли заменить между запросами — имя файла и ETag берём от прочитанных байт
+            etag = photo_etag(photo_bytes)
+            if not saved:
+                # Диск недоступен — отдаём байты как есть, без обёртки в BytesIO
+                response = app.response_class(photo_bytes, mimetype='image/jpeg', direct_passthrough=True)
+                response.set_etag(etag)
+                response.cache_control.public = True
+                response.cache_control.max_age = max_age
+                return response.make_conditional(request)
+        if PHOTO_ACCEL_PREFIX:
+            response = app.response_class(mimetype='image/jpeg')
+            response.headers['X-Accel-Redirect'] = f'{PHOTO_ACCEL_PREFIX}{photo_filename(user_id, etag)}'
+            # Cache-Control nginx переносит из ответа Flask — срок кэша зависит от ?v=, в конфиге nginx его не задать
+            response.set_etag(etag)
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+            return response
+        # Файл с диска: Last-Modified/ETag и 304 на повторный запрос, sendfile без копирования в Python.
+        # ETag — md5 содержимого, одинаковый на всех инстансах и после рестарта
+        return send_from_directory(
+            os.path.abspath(PHOTO_DIR),
+            photo_filename(user_id, etag),
+            mimetype='image/jpeg',
+            conditional=True,
+            etag=etag,
+            max_age=max_age
+        )
     except:
         pass
     return '', 404
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok'})
+    return ojson({'status': 'ok'})
 
 @app.route('/')
 def index():
-    return send_file('index.html')
+    return send_from_directory(app.static_folder, 'index.html')
 
 @app.route('/<path:filename>')
 def serve_static(filename):
-    return send_file(filename)
+    # send_from_directory не выпускает путь за пределы папки и отвечает 304 на If-None-Match/If-Modified-Since
+    return send_from_directory(app.static_folder, filename)
 
 @app.errorhandler(404)
 def not_found(e):
     if not request.path.startswith('/api/'):
-        return send_file('index.html')
-    return jsonify({'error': 'Not found'}), 404
+        return send_from_directory(app.static_folder, 'index.html')
+    return ojson({'error': 'Not found'}, 404)
 
+# Для локальной разработки; в проде — `gunicorn app:app` (см. gunicorn.conf.py)
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -1,98 +1,207 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, send_from_directory, g
 from flask_cors import CORS
 import sqlite3
 import os
-import json
-import hashlib
-import hmac
+import queue
+import itertools
+import threading
+import orjson
+import msgspec
+from typing import Annotated, List, Optional
 import time
-from datetime import datetime
-from functools import wraps
 
 app = Flask(__name__, static_folder='.', static_url_path='')
 CORS(app)
+# Статика кэшируется браузером на 5 минут, дальше — ревалидация по ETag (304 без тела)
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 300
 
 # Конфиг
 BOT_TOKEN = os.getenv('BOT_TOKEN', 'your_bot_token_here')
 DB_PATH = 'dating.db'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+STATEMENT_CACHE_SIZE = 256
+MESSAGES_BULK_LIMIT = 1000
 
 # ======================== DATABASE ========================
 
-def get_db():
-    conn = sqlite3.connect(DB_PATH)
+# Настройки соединения: действуют только на то соединение, в котором выполнены
+CONNECTION_PRAGMAS = (
+    'PRAGMA synchronous=NORMAL',      # в WAL fsync только на checkpoint, не на каждый коммит
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=268435456',     # 256 МБ файла БД читаем через mmap
+    'PRAGMA cache_size=-65536',       # 64 МБ кэша страниц
+    'PRAGMA busy_timeout=30000',      # ждём блокировку до 30 с вместо мгновенного "database is locked"
+    'PRAGMA analysis_limit=1000',     # PRAGMA optimize читает выборку индекса, а не весь
+)
+
+# Раз в OPTIMIZE_EVERY возвратов в пул обновляем статистику планировщика (sqlite_stat1)
+OPTIMIZE_EVERY = 1000
+_checkins = itertools.count(1)
+
+# Пул соединений: открытие файла, row_factory и PRAGMA — один раз на соединение, а не на запрос
+_db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+
+def connect_db():
+    # Скомпилированные запросы кэшируются на соединении по тексту SQL — пока соединение живёт в пуле,
+    # повторные запросы не проходят sqlite3_prepare заново. Разных запросов в приложении меньше лимита
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
     conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+def get_db():
+    # Одно соединение на запрос: берём из пула, обратно его вернёт release_db
+    if 'db' not in g:
+        try:
+            g.db = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db = connect_db()
+    return g.db
+
+@app.teardown_request
+def release_db(exc):
+    conn = g.pop('db', None)
+    if conn is None:
+        return
+    if conn.in_transaction:
+        conn.rollback()
+    if next(_checkins) % OPTIMIZE_EVERY == 0:
+        # Дёшево: пересчитывает только таблицы, где данные заметно выросли с прошлого ANALYZE
+        conn.execute('PRAGMA optimize')
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+# Увеличивай при изменении SCHEMA_SQL — хранится в PRAGMA user_version файла БД
+SCHEMA_VERSION = 2
+
+SCHEMA_SQL = '''
+    -- Таблица пользователей
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        age INTEGER,
+        city TEXT,
+        bio TEXT,
+        interests TEXT,
+        username TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Таблица лайков
+    CREATE TABLE IF NOT EXISTS likes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_user INTEGER,
+        to_user INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(from_user, to_user),
+        FOREIGN KEY(from_user) REFERENCES users(id),
+        FOREIGN KEY(to_user) REFERENCES users(id)
+    );
+
+    -- Таблица чатов
+    CREATE TABLE IF NOT EXISTS chats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user1_id INTEGER,
+        user2_id INTEGER,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user1_id, user2_id),
+        FOREIGN KEY(user1_id) REFERENCES users(id),
+        FOREIGN KEY(user2_id) REFERENCES users(id)
+    );
+
+    -- Таблица сообщений
+    CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER,
+        from_user INTEGER,
+        text TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(chat_id) REFERENCES chats(id),
+        FOREIGN KEY(from_user) REFERENCES users(id)
+    );
+
+    -- Версия ленты: растёт при каждом лайке пользователя. Лежит в общей БД,
+    -- поэтому кэш ленты любого воркера gunicorn видит лайк, сделанный через другой
+    CREATE TABLE IF NOT EXISTS feed_versions (
+        user_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    );
+
+    -- Индексы: SQLite сам не индексирует внешние ключи.
+    -- likes(from_user, to_user) и chats(user1_id, ...) уже покрыты UNIQUE-ограничениями
+    CREATE INDEX IF NOT EXISTS idx_likes_to_from ON likes(to_user, from_user);
+    CREATE INDEX IF NOT EXISTS idx_chats_user2 ON chats(user2_id);
+    -- Последние сообщения чата — обход индекса без сортировки
+    CREATE INDEX IF NOT EXISTS idx_messages_chat_created ON messages(chat_id, created_at DESC);
+'''
+
 def init_db():
-    conn = get_db()
-    c = conn.cursor()
+    conn = connect_db()
     
-    # Таблица пользователей
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL,
-            age INTEGER,
-            city TEXT,
-            bio TEXT,
-            interests TEXT,
-            username TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Таблица лайков
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS likes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_user INTEGER,
-            to_user INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(from_user, to_user),
-            FOREIGN KEY(from_user) REFERENCES users(id),
-            FOREIGN KEY(to_user) REFERENCES users(id)
-        )
-    ''')
-    
-    # Таблица чатов
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS chats (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user1_id INTEGER,
-            user2_id INTEGER,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            UNIQUE(user1_id, user2_id),
-            FOREIGN KEY(user1_id) REFERENCES users(id),
-            FOREIGN KEY(user2_id) REFERENCES users(id)
-        )
-    ''')
+    # WAL: чтение анкет не блокируется записью лайков/сообщений. Режим хранится в файле БД
+    conn.execute('PRAGMA journal_mode=WAL')
     
-    # Таблица сообщений
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS messages (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            chat_id INTEGER,
-            from_user INTEGER,
-            text TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY(chat_id) REFERENCES chats(id),
-            FOREIGN KEY(from_user) REFERENCES users(id)
-        )
-    ''')
-    
-    conn.commit()
+    # Схема актуальна — не разбираем DDL на каждом старте
+    if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+        # Весь DDL одним скриптом и одной транзакцией
+        conn.executescript(f'''
+            BEGIN;
+            {SCHEMA_SQL}
+            PRAGMA user_version = {SCHEMA_VERSION};
+            COMMIT;
+        ''')
+    # Статистика для планировщика с первого запроса (NOT EXISTS по likes, OR по chats)
+    conn.execute('PRAGMA optimize')
     conn.close()
 
+# ======================== REQUEST SCHEMAS ========================
+# Тело запроса разбирается и проверяется по типам в C одним вызовом — вместо request.json и цепочки data.get().
+# strict=False: числа, присланные строкой ("25"), приводятся к int, как раньше их принимал SQLite
+
+class UserIn(msgspec.Struct):
+    id: int
+    name: str
+    age: Optional[int] = None
+    city: Optional[str] = None
+    bio: Optional[str] = None
+    interests: Optional[str] = None
+    username: Optional[str] = None
+
+class LikeIn(msgspec.Struct):
+    from_user: int
+    to_user: int
+
+class MessageIn(msgspec.Struct):
+    chat_id: int
+    from_user: int
+    text: str
+
+class MessagesBulkIn(msgspec.Struct):
+    messages: Annotated[List[MessageIn], msgspec.Meta(max_length=MESSAGES_BULK_LIMIT)] = []
+
+_user_decoder = msgspec.json.Decoder(UserIn, strict=False)
+_like_decoder = msgspec.json.Decoder(LikeIn, strict=False)
+_message_decoder = msgspec.json.Decoder(MessageIn, strict=False)
+_messages_bulk_decoder = msgspec.json.Decoder(MessagesBulkIn, strict=False)
+
+def ojson(obj, status=200):
+    # orjson сериализует в C и сразу в байты — быстрее stdlib json внутри jsonify
+    return app.response_class(orjson.dumps(obj), status=status, mimetype='application/json')
+
 # ======================== STATIC ROUTES ========================
 
 @app.route('/')
 def index():
-    return send_file('index.html')
+    return send_from_directory(app.static_folder, 'index.html')
 
 @app.route('/<path:filename>')
 def serve_static(filename):
-    return send_file(filename)
+    # send_from_directory не выпускает путь за пределы папки и отвечает 304 на If-None-Match/If-Modified-Since
+    return send_from_directory(app.static_folder, filename)
 
 # ======================== API ROUTES ========================
 
@@ -102,10 +211,9 @@ def get_user(user_id):
     c = conn.cursor()
     c.execute('SELECT * FROM users WHERE id = ?', (user_id,))
     user = c.fetchone()
-    conn.close()
     
     if user:
-        return jsonify({
+        return ojson({
             'id': user['id'],
             'name': user['name'],
             'age': user['age'],
@@ -114,101 +222,120 @@ def get_user(user_id):
             'interests': user['interests'],
             'username': user['username']
         })
-    return jsonify({'error': 'User not found'}), 404
+    return ojson({'error': 'User not found'}, 404)
 
 @app.route('/api/user', methods=['POST'])
 def create_user():
-    data = request.json
-    
     conn = get_db()
-    c = conn.cursor()
     
     try:
-        c.execute('''
-            INSERT OR REPLACE INTO users 
-            (id, name, age, city, bio, interests, username, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ''', (
-            data['id'],
-            data['name'],
-            data.get('age'),
-            data.get('city'),
-            data.get('bio'),
-            data.get('interests'),
-            data.get('username')
-        ))
-        conn.commit()
-        conn.close()
+        data = _user_decoder.decode(request.get_data())
+        # with conn: COMMIT при успехе, ROLLBACK при исключении
+        with conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO users 
+                (id, name, age, city, bio, interests, username, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (
+                data.id,
+                data.name,
+                data.age,
+                data.city,
+                data.bio,
+                data.interests,
+                data.username
+            ))
         
-        return jsonify({'success': True})
-    except Exception as e:
-        conn.close()
-        return jsonify({'error': str(e)}), 400
+        return ojson({'success': True})
+    except (msgspec.DecodeError, sqlite3.Error) as e:
+        return ojson({'error': str(e)}, 400)
+
+PROFILE_COLUMNS = ('id', 'name', 'age', 'city', 'bio', 'interests')
+
+# Кэш ленты: готовые байты ответа по user_id, свой в каждом воркере. Лента меняется, когда
+# пользователь лайкает, — запись годна, пока совпадает версия из feed_versions;
+# новые анкеты появятся не позже чем через PROFILES_CACHE_TTL
+PROFILES_CACHE_TTL = 60
+PROFILES_CACHE_MAX_SIZE = 10000
+_profiles_cache = {}
+_profiles_cache_lock = threading.Lock()
 
 @app.route('/api/profiles/<int:user_id>', methods=['GET'])
 def get_profiles(user_id):
     """Получить профили для поиска (исключая пользователя и уже лайкнутые)"""
     conn = get_db()
+    # Версию берём из БД, а не из памяти: лайк мог прийти через другой воркер. Это поиск по ключу
+    row = conn.execute('SELECT version FROM feed_versions WHERE user_id = ?', (user_id,)).fetchone()
+    version = row[0] if row else 0
+    with _profiles_cache_lock:
+        cached = _profiles_cache.get(user_id)
+    if cached and cached[0] == version and time.time() - cached[1] <= PROFILES_CACHE_TTL:
+        return app.response_class(cached[2], mimetype='application/json')
+    
+    # Курсор без sqlite3.Row: строки приходят кортежами, dict собираем сразу из них
     c = conn.cursor()
+    c.row_factory = None
     
-    # Получаем ID пользователей, которых уже лайкнул текущий юзер
+    # Уже лайкнутые исключаем анти-джойном в SQL: текст запроса не растёт с числом лайков
     c.execute('''
-        SELECT to_user FROM likes WHERE from_user = ?
-    ''', (user_id,))
-    liked_ids = [row['to_user'] for row in c.fetchall()]
-    liked_ids.append(user_id)
-    
-    # Получаем профили, но исключаем уже лайкнутые
-    placeholders = ','.join('?' * len(liked_ids))
-    c.execute(f'''
-        SELECT id, name, age, city, bio, interests 
-        FROM users 
-        WHERE id NOT IN ({placeholders})
+        SELECT id, name, age, city, bio, interests
+        FROM users u
+        WHERE u.id != ?
+            AND NOT EXISTS (SELECT 1 FROM likes l WHERE l.from_user = ? AND l.to_user = u.id)
         LIMIT 50
-    ''', liked_ids)
+    ''', (user_id, user_id))
     
-    profiles = [dict(row) for row in c.fetchall()]
-    conn.close()
+    profiles = [dict(zip(PROFILE_COLUMNS, row)) for row in c.fetchall()]
     
-    return jsonify(profiles)
+    body = orjson.dumps(profiles)
+    with _profiles_cache_lock:
+        if len(_profiles_cache) >= PROFILES_CACHE_MAX_SIZE:
+            _profiles_cache.clear()
+        _profiles_cache[user_id] = (version, time.time(), body)
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/api/like', methods=['POST'])
 def like_profile():
     """Лайк профилю"""
-    data = request.json
-    
     conn = get_db()
     c = conn.cursor()
     
     try:
-        c.execute('''
-            INSERT OR IGNORE INTO likes (from_user, to_user)
-            VALUES (?, ?)
-        ''', (data['from_user'], data['to_user']))
-        conn.commit()
-        
-        # Проверяем, есть ли взаимный лайк (совпадение)
-        c.execute('''
-            SELECT * FROM likes 
-            WHERE from_user = ? AND to_user = ?
-        ''', (data['to_user'], data['from_user']))
-        
-        mutual_like = c.fetchone()
-        
-        if mutual_like:
-            # Создаём чат если его ещё нет
+        data = _like_decoder.decode(request.get_data())
+        # Лайк, проверка взаимности и чат — одна транзакция и один COMMIT (один fsync)
+        with conn:
             c.execute('''
-                INSERT OR IGNORE INTO chats (user1_id, user2_id)
+                INSERT OR IGNORE INTO likes (from_user, to_user)
                 VALUES (?, ?)
-            ''', (min(data['from_user'], data['to_user']), 
-                  max(data['from_user'], data['to_user'])))
-            conn.commit()
+            ''', (data.from_user, data.to_user))
+            
+            if c.rowcount:
+                # Лайкнутая анкета должна пропасть из ленты сразу — во всех воркерах
+                c.execute('''
+                    INSERT INTO feed_versions (user_id, version) VALUES (?, 1)
+                    ON CONFLICT(user_id) DO UPDATE SET version = version + 1
+                ''', (data.from_user,))
+            
+            # Проверяем, есть ли взаимный лайк (совпадение) — только факт существования, без чтения строки
+            c.execute('''
+                SELECT 1 FROM likes
+                WHERE from_user = ? AND to_user = ?
+                LIMIT 1
+            ''', (data.to_user, data.from_user))
+            
+            mutual_like = c.fetchone() is not None
+            
+            if mutual_like:
+                # Создаём чат если его ещё нет
+                c.execute('''
+                    INSERT OR IGNORE INTO chats (user1_id, user2_id)
+                    VALUES (?, ?)
+                ''', (min(data.from_user, data.to_user), 
+                      max(data.from_user, data.to_user)))
         
-        conn.close()
-        return jsonify({'match': bool(mutual_like)})
-    except Exception as e:
-        conn.close()
-        return jsonify({'error': str(e)}), 400
+        return ojson({'match': mutual_like})
+    except (msgspec.DecodeError, sqlite3.Error) as e:
+        return ojson({'error': str(e)}, 400)
 
 @app.route('/api/matches/<int:user_id>', methods=['GET'])
 def get_matches(user_id):
@@ -216,28 +343,25 @@ def get_matches(user_id):
     conn = get_db()
     c = conn.cursor()
     
-    # Получаем чаты пользователя
+    # Один JOIN вместо отдельного запроса на каждый чат; последнее сообщение для превью —
+    # там же, одним шагом по индексу (chat_id, created_at DESC), без запроса на каждый чат с клиента
     c.execute('''
-        SELECT user1_id, user2_id FROM chats 
-        WHERE user1_id = ? OR user2_id = ?
-    ''', (user_id, user_id))
-    
-    chats = c.fetchall()
-    matches = []
+        SELECT u.id, u.name, u.city, c.id AS chat_id,
+            m.text AS last_text, m.created_at AS last_time
+        FROM chats c
+        JOIN users u ON u.id = CASE WHEN c.user1_id = ? THEN c.user2_id ELSE c.user1_id END
+        LEFT JOIN messages m ON m.id = (
+            SELECT id FROM messages
+            WHERE chat_id = c.id
+            ORDER BY created_at DESC, id DESC
+            LIMIT 1
+        )
+        WHERE c.user1_id = ? OR c.user2_id = ?
+    ''', (user_id, user_id, user_id))
     
-    for chat in chats:
-        match_id = chat['user2_id'] if chat['user1_id'] == user_id else chat['user1_id']
-        c.execute('SELECT id, name, city FROM users WHERE id = ?', (match_id,))
-        user = c.fetchone()
-        if user:
-            matches.append({
-                'id': user['id'],
-                'name': user['name'],
-                'city': user['city']
-            })
+    matches = [dict(row) for row in c.fetchall()]
     
-    conn.close()
-    return jsonify(matches)
+    return ojson(matches)
 
 @app.route('/api/messages/<int:chat_id>', methods=['GET'])
 def get_messages(chat_id):
@@ -245,50 +369,62 @@ def get_messages(chat_id):
     conn = get_db()
     c = conn.cursor()
     
+    # Последние 50 сообщений, сразу в хронологическом порядке
     c.execute('''
-        SELECT m.id, m.from_user, m.text, m.created_at, u.name
-        FROM messages m
-        JOIN users u ON m.from_user = u.id
-        WHERE m.chat_id = ?
-        ORDER BY m.created_at DESC
-        LIMIT 50
+        SELECT * FROM (
+            SELECT m.id, m.from_user, m.text, m.created_at, u.name
+            FROM messages m
+            JOIN users u ON m.from_user = u.id
+            WHERE m.chat_id = ?
+            ORDER BY m.created_at DESC, m.id DESC
+            LIMIT 50
+        ) ORDER BY created_at ASC, id ASC
     ''', (chat_id,))
     
-    messages = [{
-        'id': row['id'],
-        'from_user': row['from_user'],
-        'name': row['name'],
-        'text': row['text'],
-        'created_at': row['created_at']
-    } for row in c.fetchall()]
+    messages = [dict(row) for row in c.fetchall()]
     
-    conn.close()
-    return jsonify(messages[::-1])
+    return ojson(messages)
 
 @app.route('/api/messages', methods=['POST'])
 def send_message():
     """Отправить сообщение"""
-    data = request.json
+    conn = get_db()
     
+    try:
+        data = _message_decoder.decode(request.get_data())
+        with conn:
+            conn.execute('''
+                INSERT INTO messages (chat_id, from_user, text)
+                VALUES (?, ?, ?)
+            ''', (data.chat_id, data.from_user, data.text))
+        
+        return ojson({'success': True})
+    except (msgspec.DecodeError, sqlite3.Error) as e:
+        return ojson({'error': str(e)}, 400)
+
+@app.route('/api/messages/bulk', methods=['POST'])
+def send_messages_bulk():
+    """Отправить пачку сообщений (например, накопленных офлайн, не больше MESSAGES_BULK_LIMIT)"""
     conn = get_db()
     c = conn.cursor()
     
     try:
-        c.execute('''
-            INSERT INTO messages (chat_id, from_user, text)
-            VALUES (?, ?, ?)
-        ''', (data['chat_id'], data['from_user'], data['text']))
-        conn.commit()
-        conn.close()
+        data = _messages_bulk_decoder.decode(request.get_data())
+        # Вся пачка — одна транзакция и один COMMIT вместо запроса и fsync на каждое сообщение
+        with conn:
+            c.executemany('''
+                INSERT INTO messages (chat_id, from_user, text)
+                VALUES (?, ?, ?)
+            ''', [(m.chat_id, m.from_user, m.text) for m in data.messages])
         
-        return jsonify({'success': True})
-    except Exception as e:
-        conn.close()
-        return jsonify({'error': str(e)}), 400
+        return ojson({'inserted': c.rowcount})
+    except (msgspec.DecodeError, sqlite3.Error) as e:
+        return ojson({'error': str(e)}, 400)
 
 @app.route('/api/health', methods=['GET'])
 def health():
-    return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()})
+    # Unix-время целым числом: без форматирования даты на каждый опрос балансировщика
+    return ojson({'status': 'ok', 'timestamp': int(time.time())})
 
 # ======================== ERROR HANDLERS ========================
 
@@ -296,16 +432,20 @@ def health():
 def not_found(e):
     # Для SPA - вернуть index.html для всех неизвестных маршрутов
     if not request.path.startswith('/api/'):
-        return send_file('index.html')
-    return jsonify({'error': 'Not found'}), 404
+        return send_from_directory(app.static_folder, 'index.html')
+    return ojson({'error': 'Not found'}, 404)
 
 @app.errorhandler(500)
 def server_error(e):
-    return jsonify({'error': 'Server error', 'message': str(e)}), 500
+    return ojson({'error': 'Server error', 'message': str(e)}, 500)
 
 # ======================== MAIN ========================
 
+# При импорте — чтобы схему создавал и gunicorn (`gunicorn app_full:app`), а не только запуск напрямую.
+# На актуальной схеме это одно чтение PRAGMA user_version
+init_db()
+
+# Для локальной разработки; в проде — `gunicorn app_full:app` (см. gunicorn.conf.py)
 if __name__ == '__main__':
-    init_db()
     port = int(os.getenv('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -2,4 +2,9 @@
 # build.sh для Render
 
 pip install -r requirements.txt
+
+# Миграции схемы — здесь, а не при старте воркеров
+if [ -n "$DATABASE_URL" ]; then
+    python migrate.py || exit 1
+fi
 echo "Build успешен!"
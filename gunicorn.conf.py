@@ -0,0 +1,20 @@
+# Конфиг gunicorn — подхватывается автоматически командой `gunicorn app:app`
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+
+# Потоковые воркеры: пока один поток ждёт Postgres, остальные обслуживают запросы.
+# GUNICORN_WORKER_CLASS=gevent — сотни запросов на воркер в ожидании БД (нужен `pip install gevent`)
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', 2))
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 100))
+
+# gthread: каждому потоку воркера — своё соединение из пула.
+# gevent: гринлетов намного больше, чем соединений, — они ждут свободное соединение в пуле
+os.environ.setdefault('DB_POOL_MAX_SIZE', str(threads if worker_class == 'gthread' else 20))
+# То же для SQLite-версии (app_full.py): по соединению на поток
+os.environ.setdefault('DB_POOL_SIZE', str(threads))
+
+# Держим соединение открытым между запросами WebApp (без нового TCP/TLS на каждый опрос)
+keepalive = 30
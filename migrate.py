@@ -0,0 +1,12 @@
+# Миграции схемы — один раз на деплой, до старта воркеров gunicorn:
+#   python migrate.py
+# Воркеры при импорте app мигрируют только пустую или отставшую схему — здесь это случается до их старта
+import sys
+
+from app import DATABASE_URL, init_db, logger
+
+if __name__ == '__main__':
+    if not DATABASE_URL:
+        logger.error('DATABASE_URL is not set')
+        sys.exit(1)
+    sys.exit(0 if init_db() else 1)